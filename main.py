@@ -1,14 +1,18 @@
 import streamlit as st
-from langchain_groq import ChatGroq
-from langchain_community.utilities import ArxivAPIWrapper, WikipediaAPIWrapper
-from langchain_community.tools import ArxivQueryRun, WikipediaQueryRun, DuckDuckGoSearchRun
-from langchain.agents import create_react_agent, AgentExecutor
-from langchain_community.callbacks.streamlit import StreamlitCallbackHandler
-from langchain import hub
+import asyncio
+import functools
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import os
 from dotenv import load_dotenv
 import re
 
+# LangChain, the Groq client and the search libraries are imported inside the cached
+# factories below, so the page is drawn before those (slow) imports run
+
 # Load environment variables
 load_dotenv()
 
@@ -99,73 +103,482 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# How long cached tool results stay valid, in seconds (arXiv and Wikipedia change at most daily)
+TOOL_CACHE_TTL = {"WebSearch": 3600, "arxiv": 86400, "wikipedia": 86400}
+TOOL_CACHE_PATH = os.path.join(".cache", "tools.json")
+TOOL_CACHE_MAX_ENTRIES = 512
+
+# Tool results keyed on tool name and normalized query, saved to disk so they survive restarts
+class ToolResultCache:
+    def __init__(self, path, max_entries=TOOL_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key, ttl):
+        entry = self._entries.get(key)
+        if entry and time.time() - entry["time"] < ttl:
+            return entry["result"]
+        return None
+
+    def set(self, key, result):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {"time": time.time(), "result": result}
+            # Entries are kept in insertion order, so the first ones are the oldest
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            try:
+                self._save()
+            except OSError:
+                pass  # The in-memory cache still works without the file
+
+# The arXiv and Wikipedia wrappers return these instead of raising when a lookup fails or finds
+# nothing, so they must not be cached as if they were results
+_UNCACHEABLE_RESULT_RE = re.compile(r'Arxiv exception|No good .* Result was found')
+
+# Serve repeated queries to a tool from the cache instead of hitting the network again
+def cache_tool_results(tool, cache, ttl):
+    run = tool._run
+
+    @functools.wraps(run)
+    def cached_run(query, *args, **kwargs):
+        key = f"{tool.name}:{query.strip().lower()}"
+        result = cache.get(key, ttl)
+        if result is None:
+            result = run(query, *args, **kwargs)
+            if result and not _UNCACHEABLE_RESULT_RE.match(result):
+                cache.set(key, result)
+        return result
+
+    tool._run = cached_run
+    return tool
+
+# Patterns used to shrink arXiv and Wikipedia results before they enter the prompt
+_WHITESPACE_RE = re.compile(r'\s+')
+_CITATION_RE = re.compile(r'\[\d+\]')
+# The "Summary:" label both wrappers put on its own line before the text (the Published, Title,
+# Authors and Page lines carry content and stay)
+_SUMMARY_HEADER_RE = re.compile(r'\n\s*Summary:\s*')
+
+# Most characters a compacted arXiv or Wikipedia tool output may put into the prompt
+TOOL_OUTPUT_CHARS_MAX = 300
+
+# Drop the summary header and citation markers and collapse whitespace in each result of a
+# tool's output, then cut each result to an equal share of TOOL_OUTPUT_CHARS_MAX. Cutting after
+# compaction means the budget is spent on content rather than labels and whitespace.
+def compact_tool_output(tool):
+    run = tool._run
+
+    @functools.wraps(run)
+    def compact_run(*args, **kwargs):
+        results = [
+            _WHITESPACE_RE.sub(' ', _CITATION_RE.sub('', _SUMMARY_HEADER_RE.sub(' - ', result))).strip()
+            for result in run(*args, **kwargs).split('\n\n')
+        ]
+        results = [result for result in results if result]
+        if not results:
+            return ''
+        # Results are separated by blank lines, keep that so the LLM can still tell them apart
+        share = (TOOL_OUTPUT_CHARS_MAX - 2 * (len(results) - 1)) // len(results)
+        return '\n\n'.join(result[:share].rstrip() for result in results)
+
+    tool._run = compact_run
+    return tool
+
+# One keep-alive connection pool shared by the arXiv and Wikipedia tools
+def create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)  # The wikipedia package talks to plain http endpoints
+    return session
+
+# arxiv.Search whose results are fetched over the shared session instead of a new one per query
+def pooled_arxiv_search(session):
+    import arxiv
+
+    class PooledSearch(arxiv.Search):
+        def results(self, offset=0):
+            # Only fetch as many entries as the wrapper asked for instead of a full 100-entry page
+            client = arxiv.Client(page_size=int(min(self.max_results or 100, 100)))
+            client._session = session
+            return client.results(self, offset=offset)
+    return PooledSearch
+
+# Maximum number of tool calls run at the same time within one agent step
+# (also the number of searches one batch_search call runs at once)
+TOOL_CONCURRENCY_LIMIT = max(1, int(os.getenv("TOOL_CONCURRENCY_LIMIT", "3")))
+
+# Maximum number of queries a single batch_search call runs
+MAX_BATCH_QUERIES = 5
+
+# Web search over several queries at once, so the model needs one tool call instead of several
+def create_batch_search(search):
+    from langchain_core.tools import StructuredTool
+
+    # StructuredTool passes the run's child callbacks in, so each search shows up in the thoughts panel
+    async def abatch_search(queries: list[str], callbacks=None) -> str:
+        semaphore = asyncio.Semaphore(TOOL_CONCURRENCY_LIMIT)
+
+        async def run_query(query):
+            async with semaphore:
+                return await search.ainvoke(query, {"callbacks": callbacks})
+
+        queries = list(dict.fromkeys(queries))
+        searched = queries[:MAX_BATCH_QUERIES]
+        results = await asyncio.gather(*(run_query(query) for query in searched), return_exceptions=True)
+        output = {
+            query: f"Error: {result}" if isinstance(result, Exception) else result
+            for query, result in zip(searched, results)
+        }
+        for query in queries[MAX_BATCH_QUERIES:]:
+            output[query] = f"Skipped: batch_search runs at most {MAX_BATCH_QUERIES} queries per call"
+        return json.dumps(output)
+
+    def batch_search(queries: list[str], callbacks=None) -> str:
+        return asyncio.run(abatch_search(queries, callbacks))
+
+    return StructuredTool.from_function(
+        func=batch_search,
+        coroutine=abatch_search,
+        name="batch_search",
+        description=(
+            f"Search the web for several queries at once. Input is a list of up to {MAX_BATCH_QUERIES} search queries, "
+            "the output is a JSON object with the results for each query. "
+            "Use this instead of WebSearch when you need more than one web lookup."
+        )
+    )
+
 # Initialize tools with enhanced configuration
+# (the agent awaits them through BaseTool.arun, which moves the blocking HTTP calls off the event loop)
 @st.cache_resource
 def initialize_tools():
-    arxiv_wrapper = ArxivAPIWrapper(top_k_results=3, doc_content_chars_max=500)
-    arxiv = ArxivQueryRun(api_wrapper=arxiv_wrapper)
+    from langchain_community.utilities import ArxivAPIWrapper, WikipediaAPIWrapper
+    from langchain_community.tools import ArxivQueryRun, WikipediaQueryRun, DuckDuckGoSearchRun
+    import wikipedia
+
+    session = create_http_session()
+    
+    # doc_content_chars_max only bounds what is fetched, compact_tool_output caps what the LLM sees
+    arxiv_wrapper = ArxivAPIWrapper(top_k_results=2, doc_content_chars_max=2000)
+    arxiv_wrapper.arxiv_search = pooled_arxiv_search(session)
+    arxiv_tool = compact_tool_output(ArxivQueryRun(api_wrapper=arxiv_wrapper))
 
-    wikipedia_wrapper = WikipediaAPIWrapper(top_k_results=3, doc_content_chars_max=500)
-    wiki = WikipediaQueryRun(api_wrapper=wikipedia_wrapper)
+    # The wikipedia package only ever calls requests.get, which the session provides as well.
+    # This patches the module for the whole process, not just these tools.
+    wikipedia.wikipedia.requests = session
+
+    wikipedia_wrapper = WikipediaAPIWrapper(top_k_results=2, doc_content_chars_max=2000)
+    wiki = compact_tool_output(WikipediaQueryRun(api_wrapper=wikipedia_wrapper))
 
     search = DuckDuckGoSearchRun(name="WebSearch")
     
-    return [search, arxiv, wiki]
+    cache = ToolResultCache(TOOL_CACHE_PATH)
+    tools = [cache_tool_results(tool, cache, TOOL_CACHE_TTL[tool.name]) for tool in (search, arxiv_tool, wiki)]
+    
+    # Goes through the cached WebSearch tool, so batched queries share its cache
+    tools.append(create_batch_search(tools[0]))
+    return tools
+
+# Print agent steps to stdout only when asked for, e.g. while debugging locally
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE", "0") == "1"
+
+SYSTEM_PROMPT = (
+    "You are Syam's Search Assistant. You can search the web, find academic papers on arXiv "
+    "and browse Wikipedia to answer the user's question. "
+    "If a question needs several independent lookups, issue them in a single response "
+    "instead of one at a time, and prefer batch_search when you need several web searches. "
+    "Answer as soon as the results you have are enough, without repeating similar searches."
+)
+
+# Callback handler class that draws the agent's thoughts, built once on first use.
+# The stock StreamlitCallbackHandler keeps a single "current thought" and closes it on the first
+# on_tool_end, so the second of two parallel tool calls lost its output. This one gives every
+# tool call of a step its own thought, keyed on the tool's run_id. Tools run from inside another
+# tool (the searches of batch_search) are listed in their parent's thought instead.
+@st.cache_resource
+def get_callback_handler_class():
+    from langchain_community.callbacks.streamlit.streamlit_callback_handler import (
+        LLMThought,
+        StreamlitCallbackHandler
+    )
+
+    class ParallelStreamlitCallbackHandler(StreamlitCallbackHandler):
+        # Streamlit only accepts updates from the script thread, so run the callbacks inline on
+        # the event loop instead of in LangChain's default executor
+        run_inline = True
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._tool_thoughts = {}
+            self._nested_tools = set()
+
+        def _new_thought(self):
+            return LLMThought(
+                parent_container=self._parent_container,
+                expanded=self._expand_new_thoughts,
+                collapse_on_complete=self._collapse_completed_thoughts,
+                labeler=self._thought_labeler
+            )
+
+        def _complete_thought(self, thought):
+            thought.complete()
+            self._completed_thoughts.append(thought)
+            if thought is self._current_thought:
+                self._current_thought = None
+            self._prune_old_thought_containers()
+
+        def on_agent_action(self, action, color=None, **kwargs):
+            # All actions of a step are announced before their tools end, nothing to draw here
+            pass
+
+        def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+            if parent_run_id in self._tool_thoughts:
+                thought = self._tool_thoughts[parent_run_id]
+                thought.container.markdown(f"🔎 **{serialized['name']}:** {input_str}")
+                self._tool_thoughts[run_id] = thought
+                self._nested_tools.add(run_id)
+                return
+            # The first tool of a step continues the LLM's thought, the others get their own
+            if self._current_thought is not None and self._current_thought.last_tool is None:
+                thought = self._current_thought
+            else:
+                thought = self._new_thought()
+            thought.on_tool_start(serialized, input_str)
+            self._tool_thoughts[run_id] = thought
+            self._prune_old_thought_containers()
+
+        def on_tool_end(self, output, color=None, observation_prefix=None, llm_prefix=None, *, run_id, **kwargs):
+            thought = self._tool_thoughts.pop(run_id, None)
+            if run_id in self._nested_tools:
+                # The parent tool's own output already contains this result
+                self._nested_tools.discard(run_id)
+            elif thought is not None:
+                thought.on_tool_end(str(output), color, observation_prefix, llm_prefix)
+                self._complete_thought(thought)
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            thought = self._tool_thoughts.pop(run_id, None)
+            if run_id in self._nested_tools:
+                # Report it, but leave the parent's thought open until the parent ends
+                self._nested_tools.discard(run_id)
+                thought.on_tool_error(error)
+            elif thought is not None:
+                thought.on_tool_error(error)
+                self._complete_thought(thought)
+
+    return ParallelStreamlitCallbackHandler
+
+# Streamlit callback handler that draws the agent's thoughts into the given container
+def create_callback_handler(container):
+    return get_callback_handler_class()(
+        container, 
+        expand_new_thoughts=False  # Removed invalid thought_label parameter
+    )
+
+# Shared Groq client for the agent and the direct-response fallback
+@st.cache_resource
+def get_llm(api_key):
+    from langchain_groq import ChatGroq
+
+    return ChatGroq(
+        groq_api_key=api_key, 
+        model_name="llama-3.1-8b-instant", 
+        streaming=True,
+        temperature=0.1
+    )
 
 # Initialize the agent executor
 @st.cache_resource
 def initialize_agent(api_key):
+    from langchain.agents import create_tool_calling_agent, AgentExecutor
+    from langchain_core.agents import AgentStep
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from pydantic import PrivateAttr
+
+    # Agent executor that runs all tool calls of a step concurrently instead of one after another.
+    # AgentExecutor's async loop already awaits the actions of a step with asyncio.gather, so this
+    # only bounds how many run at once and keeps one failing tool from cancelling the others.
+    class ParallelAgentExecutor(AgentExecutor):
+        max_concurrency: int = TOOL_CONCURRENCY_LIMIT
+        _semaphores: weakref.WeakKeyDictionary = PrivateAttr(default_factory=weakref.WeakKeyDictionary)
+
+        def _get_semaphore(self):
+            # Every turn runs on a fresh event loop, so keep one semaphore per loop
+            loop = asyncio.get_running_loop()
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return self._semaphores[loop]
+
+        async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+            async with self._get_semaphore():
+                try:
+                    return await super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+                except Exception as e:
+                    # Report the failure to the LLM instead of cancelling the other calls
+                    return AgentStep(
+                        action=agent_action,
+                        observation=f"Error: {agent_action.tool} failed ({type(e).__name__}: {e})"
+                    )
+
     try:
-        llm = ChatGroq(
-            groq_api_key=api_key, 
-            model_name="llama-3.1-8b-instant", 
-            streaming=True,
-            temperature=0.1
-        )
+        llm = get_llm(api_key)
         tools = initialize_tools()
-        prompt_template = hub.pull("hwchase17/react")
-        agent = create_react_agent(llm, tools, prompt_template)
-        agent_executor = AgentExecutor(
+        prompt_template = ChatPromptTemplate.from_messages([
+            ("system", SYSTEM_PROMPT),
+            ("human", "{input}"),
+            MessagesPlaceholder("agent_scratchpad")
+        ])
+        agent = create_tool_calling_agent(llm, tools, prompt_template)
+        agent_executor = ParallelAgentExecutor(
             agent=agent, 
             tools=tools, 
-            verbose=True, 
+            verbose=AGENT_VERBOSE, 
             handle_parsing_errors=True,
-            max_iterations=5
+            max_iterations=3,
+            max_execution_time=20.0
         )
         return agent_executor
     except Exception as e:
         st.error(f"Error initializing agent: {str(e)}")
         return None
 
+# Patterns used by extract_sources, compiled once at import
+_URL_RE = re.compile(r'https?://[\w$\-@.&+!*(),%/:;=?#~]+')
+_ACADEMIC_KW = ('arxiv', 'paper', 'research', 'study')
+_ENCYCLOPEDIA_KW = ('wikipedia', 'wiki')
+# Upper bound on the number of entries extract_sources returns, keyword fallbacks included
+MAX_SOURCES = 10
+
+# Number of chat messages drawn per run, and how many more "Show earlier messages" adds
+HISTORY_WINDOW = 30
+
+# Display titles for each source type
+_SOURCE_TITLES = {
+    "academic": "arXiv Academic Paper",
+    "encyclopedia": "Wikipedia Article",
+    "research": "Research Paper",
+    "web": "Web Source"
+}
+
+# Drop sentence punctuation the URL pattern picks up at the end of a link, keeping a closing
+# parenthesis that belongs to the URL itself (e.g. Wikipedia's "..._(deep_learning)")
+def _clean_url(url):
+    url = url.rstrip('.,;:')
+    while url.endswith(')') and url.count(')') > url.count('('):
+        url = url[:-1].rstrip('.,;:')
+    return url
+
 # Function to extract sources from response
 def extract_sources(response_text):
     sources = []
+    types_seen = set()
     
-    # Extract URLs
-    url_pattern = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
-    urls = re.findall(url_pattern, response_text)
-    
-    for url in urls:
-        # Categorize sources based on URL patterns
-        if 'arxiv.org' in url:
-            sources.append({"title": "arXiv Academic Paper", "url": url, "type": "academic"})
-        elif 'wikipedia.org' in url:
-            sources.append({"title": "Wikipedia Article", "url": url, "type": "encyclopedia"})
-        elif 'doi.org' in url:
-            sources.append({"title": "Research Paper", "url": url, "type": "research"})
-        else:
-            sources.append({"title": "Web Source", "url": url, "type": "web"})
+    # Extract unique URLs and categorize them based on URL patterns
+    for url in dict.fromkeys(_clean_url(url) for url in _URL_RE.findall(response_text)):
+        if len(sources) == MAX_SOURCES:
+            break
+        source_type = ('academic' if 'arxiv.org' in url else
+                       'encyclopedia' if 'wikipedia.org' in url else
+                       'research' if 'doi.org' in url else
+                       'web')
+        sources.append({"title": _SOURCE_TITLES[source_type], "url": url, "type": source_type})
+        types_seen.add(source_type)
     
     # Add source indicators based on content
-    if any(keyword in response_text.lower() for keyword in ['arxiv', 'paper', 'research', 'study']):
-        if not any(s['type'] == 'academic' for s in sources):
-            sources.append({"title": "arXiv Repository", "url": "https://arxiv.org", "type": "academic"})
+    lowered = response_text.lower()
+    if 'academic' not in types_seen and any(keyword in lowered for keyword in _ACADEMIC_KW):
+        sources.append({"title": "arXiv Repository", "url": "https://arxiv.org", "type": "academic"})
+        types_seen.add('academic')
     
-    if any(keyword in response_text.lower() for keyword in ['wikipedia', 'wiki']):
-        if not any(s['type'] == 'encyclopedia' for s in sources):
-            sources.append({"title": "Wikipedia", "url": "https://wikipedia.org", "type": "encyclopedia"})
+    if 'encyclopedia' not in types_seen and any(keyword in lowered for keyword in _ENCYCLOPEDIA_KW):
+        sources.append({"title": "Wikipedia", "url": "https://wikipedia.org", "type": "encyclopedia"})
+        types_seen.add('encyclopedia')
     
-    return sources
+    return sources[:MAX_SOURCES]
+
+# Build the sources section as one HTML block so it is sent to the page in a single element
+def render_sources(sources):
+    html = ['<div class="sources-section"><b>📚 Sources & References:</b>']
+    for source in sources:
+        if source.get("url"):
+            html.append(f'<a href="{source["url"]}" class="source-link" target="_blank">🔗 {source["title"]}</a>')
+        else:
+            html.append(f'<div class="source-link">📄 {source["title"]}</div>')
+    html.append('</div>')
+    return "".join(html)
+
+# Chat history is kept as three parallel lists (roles, contents, sources), one entry per message
+def reset_chat(greeting):
+    st.session_state.roles = ["assistant"]
+    st.session_state.contents = [greeting]
+    st.session_state.sources = [[]]
+
+def add_message(role, content, sources=None):
+    st.session_state.roles.append(role)
+    st.session_state.contents.append(content)
+    st.session_state.sources.append(sources or [])
+
+# Like asyncio.run, but without waiting for blocking tool calls that max_execution_time cut off.
+# Those keep running in their executor threads and finish in the background, so the answer is
+# not held back until the slowest lookup returns.
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor()
+    loop.set_default_executor(executor)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        executor.shutdown(wait=False, cancel_futures=True)
+        loop.close()
+
+# Run the agent and render the final answer token by token as it is generated
+async def stream_agent_response(agent_executor, user_message, message_placeholder, callbacks):
+    tokens = []
+    output = None
+    async for event in agent_executor.astream_events(
+        {"input": user_message}, 
+        {"callbacks": callbacks}, 
+        version="v2"
+    ):
+        kind = event["event"]
+        if kind == "on_chat_model_start":
+            # Only the last LLM call of the run produces the answer, earlier ones pick tools
+            tokens = []
+        elif kind == "on_chat_model_stream":
+            token = event["data"]["chunk"].content
+            if token:
+                tokens.append(token)
+                message_placeholder.markdown(f'<div class="assistant-message">{"".join(tokens)}</div>', unsafe_allow_html=True)
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            output = event["data"]["output"].get("output")
+    
+    return output if output is not None else "".join(tokens)
 
 # Header section
 st.markdown('<div class="main-header"> Syam\'s Search Assistant</div>', unsafe_allow_html=True)
@@ -185,66 +598,56 @@ if not api_key:
     st.stop()
 
 # Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {
-            "role": "assistant", 
-            "content": "Hello! I'm your Syam's Search Assistant. I can help you search the web, find academic papers, and browse Wikipedia. What would you like to explore today?",
-            "sources": []
-        }
-    ]
+if "roles" not in st.session_state:
+    reset_chat("Hello! I'm your Syam's Search Assistant. I can help you search the web, find academic papers, and browse Wikipedia. What would you like to explore today?")
 
 if "agent" not in st.session_state:
     with st.spinner("🔄 Initializing research assistant..."):
         st.session_state.agent = initialize_agent(api_key)
 
+# Only the most recent messages are drawn on each run, older ones are loaded on request
+if "window" not in st.session_state:
+    st.session_state.window = HISTORY_WINDOW
+
+hidden_count = len(st.session_state.roles) - st.session_state.window
+if hidden_count > 0 and st.button(f"⬆️ Show earlier messages ({hidden_count} hidden)"):
+    st.session_state.window += HISTORY_WINDOW
+
 # Display chat messages with sources
-for message in st.session_state.messages:
-    if message["role"] == "user":
-        st.markdown(f'<div class="user-message">{message["content"]}</div>', unsafe_allow_html=True)
+start = -st.session_state.window
+for role, content, message_sources in zip(
+    st.session_state.roles[start:],
+    st.session_state.contents[start:],
+    st.session_state.sources[start:]
+):
+    if role == "user":
+        st.markdown(f'<div class="user-message">{content}</div>', unsafe_allow_html=True)
     else:
         with st.chat_message("assistant"):
-            st.markdown(f'<div class="assistant-message">{message["content"]}</div>', unsafe_allow_html=True)
+            st.markdown(f'<div class="assistant-message">{content}</div>', unsafe_allow_html=True)
             
             # Display sources if available
-            if message.get("sources"):
-                with st.container():
-                    st.markdown('<div class="sources-section">', unsafe_allow_html=True)
-                    st.markdown("**📚 Sources & References:**")
-                    for source in message["sources"]:
-                        if source.get("url"):
-                            st.markdown(
-                                f'<a href="{source["url"]}" class="source-link" target="_blank">🔗 {source["title"]}</a>', 
-                                unsafe_allow_html=True
-                            )
-                        else:
-                            st.markdown(f'<div class="source-link">📄 {source["title"]}</div>', unsafe_allow_html=True)
-                    st.markdown('</div>', unsafe_allow_html=True)
+            if message_sources:
+                st.markdown(render_sources(message_sources), unsafe_allow_html=True)
 
 # Quick action buttons
+# (a pressed button or submitted prompt is answered further down in the same script run)
+pending_prompt = None
 st.markdown("---")
 col1, col2, col3, col4 = st.columns(4)
 with col1:
     if st.button("🎯 Latest AI Research", use_container_width=True):
-        st.session_state.messages.append({"role": "user", "content": "Find the latest research papers about artificial intelligence from arXiv"})
-        st.rerun()
+        pending_prompt = "Find the latest research papers about artificial intelligence from arXiv"
 with col2:
     if st.button("🌐 Search Wikipedia", use_container_width=True):
-        st.session_state.messages.append({"role": "user", "content": "Search Wikipedia for current events in technology"})
-        st.rerun()
+        pending_prompt = "Search Wikipedia for current events in technology"
 with col3:
     if st.button("🔍 Web Search", use_container_width=True):
-        st.session_state.messages.append({"role": "user", "content": "Search the web for recent developments in machine learning"})
-        st.rerun()
+        pending_prompt = "Search the web for recent developments in machine learning"
 with col4:
     if st.button("🧹 Clear Chat", use_container_width=True):
-        st.session_state.messages = [
-            {
-                "role": "assistant", 
-                "content": "Chat cleared! How can I assist you with your research today?",
-                "sources": []
-            }
-        ]
+        reset_chat("Chat cleared! How can I assist you with your research today?")
+        st.session_state.window = HISTORY_WINDOW
         st.rerun()
 
 # Chat input
@@ -254,16 +657,15 @@ if prompt := st.chat_input("Ask me anything about research, news, or academic to
         st.error("Research assistant is not properly initialized. Please check your API key.")
         st.stop()
     
-    # Add user message to chat
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    st.rerun()
-
-# Process the latest user message
-if (st.session_state.messages and 
-    st.session_state.messages[-1]["role"] == "user" and 
-    st.session_state.agent):
+    pending_prompt = prompt
+
+# Process the new user message
+if pending_prompt and st.session_state.agent:
+    user_message = pending_prompt
     
-    user_message = st.session_state.messages[-1]["content"]
+    # Add user message to chat and show it right away, the history above is already drawn
+    add_message("user", user_message)
+    st.markdown(f'<div class="user-message">{user_message}</div>', unsafe_allow_html=True)
     
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
@@ -271,45 +673,32 @@ if (st.session_state.messages and
         
         try:
             # Initialize callback handler with correct parameters
-            st_cb = StreamlitCallbackHandler(
-                st.container(), 
-                expand_new_thoughts=False  # Removed invalid thought_label parameter
-            )
+            st_cb = create_callback_handler(st.container())
             
-            # Execute the agent
+            # Execute the agent, streaming the answer into the placeholder
             with st.spinner("🔍 Searching for information..."):
-                response = st.session_state.agent.invoke(
-                    {"input": user_message}, 
-                    {"callbacks": [st_cb]}
-                )
+                output = run_async(stream_agent_response(
+                    st.session_state.agent,
+                    user_message,
+                    message_placeholder,
+                    [st_cb]
+                ))
             
             # Extract response
-            output = response.get("output", "I apologize, but I couldn't generate a proper response.")
+            output = output or "I apologize, but I couldn't generate a proper response."
             
             # Extract sources from the response
             sources = extract_sources(output)
             
             # Add assistant response to chat
-            st.session_state.messages.append({
-                "role": "assistant", 
-                "content": output,
-                "sources": sources
-            })
+            add_message("assistant", output, sources)
             
             # Display the response
             message_placeholder.markdown(f'<div class="assistant-message">{output}</div>', unsafe_allow_html=True)
             
             # Display sources
             if sources:
-                with sources_placeholder.container():
-                    st.markdown('<div class="sources-section">', unsafe_allow_html=True)
-                    st.markdown("**📚 Sources & References:**")
-                    for source in sources:
-                        st.markdown(
-                            f'<a href="{source["url"]}" class="source-link" target="_blank">🔗 {source["title"]}</a>', 
-                            unsafe_allow_html=True
-                        )
-                    st.markdown('</div>', unsafe_allow_html=True)
+                sources_placeholder.markdown(render_sources(sources), unsafe_allow_html=True)
             
         except Exception as e:
             error_msg = f"I encountered an issue while searching: {str(e)}. Let me provide a direct response instead."
@@ -317,40 +706,23 @@ if (st.session_state.messages and
             
             try:
                 # Fallback to direct LLM response
-                llm = ChatGroq(groq_api_key=api_key, model_name="llama-3.1-8b-instant")
-                direct_response = llm.invoke(user_message)
+                direct_response = get_llm(api_key).invoke(user_message)
                 fallback_content = direct_response.content
                 
                 # Extract sources even from fallback response
                 fallback_sources = extract_sources(fallback_content)
                 
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": f"{fallback_content}",
-                    "sources": fallback_sources
-                })
+                add_message("assistant", fallback_content, fallback_sources)
                 
                 message_placeholder.markdown(f'<div class="assistant-message">{fallback_content}</div>', unsafe_allow_html=True)
                 
                 # Display sources for fallback response
                 if fallback_sources:
-                    with sources_placeholder.container():
-                        st.markdown('<div class="sources-section">', unsafe_allow_html=True)
-                        st.markdown("**📚 Sources & References:**")
-                        for source in fallback_sources:
-                            st.markdown(
-                                f'<a href="{source["url"]}" class="source-link" target="_blank">🔗 {source["title"]}</a>', 
-                                unsafe_allow_html=True
-                            )
-                        st.markdown('</div>', unsafe_allow_html=True)
+                    sources_placeholder.markdown(render_sources(fallback_sources), unsafe_allow_html=True)
                 
             except Exception as llm_error:
                 final_error = "I'm experiencing technical difficulties. Please try again in a moment."
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": final_error,
-                    "sources": []
-                })
+                add_message("assistant", final_error)
                 message_placeholder.markdown(f'<div class="assistant-message">{final_error}</div>', unsafe_allow_html=True)
 
 # Footer